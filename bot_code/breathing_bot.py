@@ -1,189 +1,331 @@
 import os
 import discord
-from discord.ext import commands
+from discord import app_commands
 from dotenv import load_dotenv
 import asyncio
+import logging
+import random
+import subprocess
 import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from discord.oggparse import OggStream
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger("breathing_bot")
+
 # Bot setup
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Voice-connected members arrive with voice state events, so the
+# privileged member list (and its startup chunking) isn't needed
+intents = discord.Intents.none()
+intents.guilds = True
+intents.voice_states = True
+# Slash commands only – a plain Client never parses messages, so no
+# message_content intent
+bot = discord.Client(intents=intents)
+tree = app_commands.CommandTree(bot)
 
 # -------------------------------------------------------------
 # CONFIGURATION – EDIT THESE TWO VALUES
 # -------------------------------------------------------------
 LOCAL_MP3_PATH = "/opt/render/project/src/assets/meditation music.mp3"
-VOICE_CHANNEL_ID = int(os.getenv("VOICE_CHANNEL_ID"))
+VOICE_CHANNEL_ID = int(os.getenv("VOICE_CHANNEL_ID") or 0)
 # -------------------------------------------------------------
 
-FFMPEG_OPTIONS = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    'options': '-vn'
-}
+# Set SYNC_COMMANDS=1 for one start after changing slash commands;
+# syncing is rate-limited, so it is not done on every restart
+SYNC_COMMANDS = os.getenv("SYNC_COMMANDS") == "1"
+
+# One-shot decode of the MP3 into 20ms Opus packets in an Ogg container
+FFMPEG_OPUS_ARGS = [
+    'ffmpeg', '-nostdin', '-i', LOCAL_MP3_PATH, '-vn', '-map_metadata', '-1',
+    '-c:a', 'libopus', '-ar', '48000', '-ac', '2', '-b:a', '128k',
+    '-frame_duration', '20', '-f', 'opus', '-loglevel', 'warning', 'pipe:1'
+]
+
+# Breathing guide posted on every join – built once, reused
+GIF_URL = os.getenv("GIF_URL")
+BREATHING_EMBED = discord.Embed(
+    title="🌬️ BREATHING BRIDGE ACTIVATED",
+    description="INHALE 4s → HOLD 7s → EXHALE 8s",
+    color=0x00ff88
+)
+if GIF_URL:
+    BREATHING_EMBED.set_image(url=GIF_URL)
+
+# Voice connect retry: capped exponential backoff with jitter
+VOICE_CONNECT_ATTEMPTS = 5
+VOICE_BACKOFF_INITIAL = 1.0
+VOICE_BACKOFF_MAX = 30.0
+
 
-# Global state
-voice_client = None
-disconnect_timer = None
+# -------------------------------------------------------------
+# Runtime state
+# -------------------------------------------------------------
+@dataclass(slots=True)
+class BotState:
+    target_channel: Optional[discord.VoiceChannel] = None  # resolved once in on_ready
+    vc: Optional[discord.VoiceClient] = None
+    disconnect_task: Optional[asyncio.Task] = None
+    deadline: float = 0.0  # time.monotonic() at which to auto-disconnect
+    decode_task: Optional[asyncio.Task] = None  # started in setup_hook, shared by every playback
+    connect_lock: asyncio.Lock = field(default_factory=asyncio.Lock)  # one connect/play at a time
+
+
+bot.state = BotState()
 
 
 # -------------------------------------------------------------
-# Robust voice connect helper (inserted between globals & play_music)
+# Robust voice connect helper (inserted between state & play_music)
 # -------------------------------------------------------------
 async def connect_voice(channel: discord.VoiceChannel):
-    for attempt in range(1, 6):
+    for attempt in range(1, VOICE_CONNECT_ATTEMPTS + 1):
         try:
             return await channel.connect(timeout=15, reconnect=False)
+        except asyncio.TimeoutError:
+            logger.debug("[voice] %d/%d  timed out", attempt, VOICE_CONNECT_ATTEMPTS)
+            if attempt == VOICE_CONNECT_ATTEMPTS:
+                raise
         except discord.ConnectionClosed as e:
-            print(f"[voice] {attempt}/5  4006 hit — {e}")
-            if attempt == 5:
+            # connect() only unregisters its half-built client on timeout;
+            # drop it here or every later attempt hits "Already connected"
+            if channel.guild.voice_client:
+                await channel.guild.voice_client.disconnect(force=True)
+            # 4006 = session no longer valid, worth retrying; anything else
+            # (e.g. 4014, kicked from the channel) is final
+            if e.code != 4006 or attempt == VOICE_CONNECT_ATTEMPTS:
                 raise
-            await asyncio.sleep(5 * attempt)
+            logger.debug("[voice] %d/%d  4006 hit — %s", attempt, VOICE_CONNECT_ATTEMPTS, e)
+
+        delay = min(VOICE_BACKOFF_MAX, VOICE_BACKOFF_INITIAL * 2 ** (attempt - 1))
+        await asyncio.sleep(delay * (0.5 + random.random() * 0.5))
 
 
 # -------------------------------------------------------------
 # Music helpers
 # -------------------------------------------------------------
+def load_opus_frames() -> list[bytes]:
+    """Decode the local MP3 once and return its Opus packets."""
+    # Parse straight off the pipe so the whole Ogg stream is never buffered
+    with subprocess.Popen(FFMPEG_OPUS_ARGS, stdout=subprocess.PIPE) as proc:
+        frames = [
+            packet for packet in OggStream(proc.stdout).iter_packets()
+            if not packet.startswith((b'OpusHead', b'OpusTags'))
+        ]
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, FFMPEG_OPUS_ARGS)
+    if not frames:
+        raise RuntimeError("FFmpeg produced no Opus frames")
+    return frames
+
+
+class LoopedOpusSource(discord.AudioSource):
+    """Endless loop over pre-encoded Opus frames – no FFmpeg per playback."""
+
+    def __init__(self, frames: list[bytes]):
+        self.frames = frames
+        self.index = 0
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return frame
+
+
+async def decode_music():
+    """Run the one-time decode off the event loop; None if it failed."""
+    if not os.path.isfile(LOCAL_MP3_PATH):
+        logger.error("❌ MP3 file not found: %s", LOCAL_MP3_PATH)
+        return None
+    try:
+        frames = await asyncio.to_thread(load_opus_frames)
+    except Exception:
+        logger.exception("❌ Decode error")
+        return None
+    logger.info("🎼 Decoded %d Opus frames", len(frames))
+    return frames
+
+
 async def play_music(vc: discord.VoiceClient):
-    """Start playing the local MP3."""
+    """Start looping the local MP3."""
     if vc.is_playing():
         return
 
-    if not os.path.isfile(LOCAL_MP3_PATH):
-        print(f"❌ MP3 file not found: {LOCAL_MP3_PATH}")
+    # Normally finished long before the first join
+    frames = await bot.state.decode_task
+    if frames is None:
         return
 
     try:
-        source = discord.FFmpegPCMAudio(LOCAL_MP3_PATH, **FFMPEG_OPTIONS)
-        vc.play(source, after=lambda e: asyncio.create_task(restart_music(vc)) if not e else print(f"Player error: {e}"))
-        print("🎵 MP3 started")
-    except Exception as e:
-        print(f"❌ Play error: {e}")
+        vc.play(LoopedOpusSource(frames), after=lambda e: logger.error("Player error: %s", e) if e else None)
+        logger.info("🎵 MP3 started")
+    except Exception:
+        logger.exception("❌ Play error")
 
 
-async def restart_music(vc: discord.VoiceClient):
-    """Restart track on finish."""
-    await asyncio.sleep(2)
-    if vc and vc.is_connected() and not vc.is_playing():
-        await play_music(vc)
+async def teardown_voice(vc: discord.VoiceClient):
+    """Stop playback and drop the voice connection (also cleans up the client)."""
+    if vc.is_playing():
+        vc.stop()
+    await vc.disconnect(force=True)
 
 
 async def schedule_disconnect():
-    """Auto-disconnect after 10 minutes of inactivity."""
-    global voice_client, disconnect_timer
-    await asyncio.sleep(600)
-    if voice_client and voice_client.is_connected():
-        await voice_client.disconnect()
-        print("🔇 Auto-disconnected after 10 minutes")
-    voice_client = None
-    disconnect_timer = None
+    """Auto-disconnect once the deadline passes; joins push it back."""
+    state = bot.state
+    while True:
+        while (remaining := state.deadline - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+        async with state.connect_lock:
+            # A join may have pushed the deadline back while we waited
+            if state.deadline > time.monotonic():
+                continue
+            vc = state.vc
+            if vc and vc.is_connected():
+                await teardown_voice(vc)
+                logger.info("🔇 Auto-disconnected after 10 minutes")
+            if state.vc is vc:
+                state.vc = None
+            state.disconnect_task = None
+            return
 
 
 # -------------------------------------------------------------
 # Discord events
 # -------------------------------------------------------------
+@bot.event
+async def setup_hook():
+    bot.state.decode_task = asyncio.create_task(decode_music())
+    if SYNC_COMMANDS:
+        synced = await tree.sync()
+        logger.info("🔁 Synced %d slash commands", len(synced))
+
+
 @bot.event
 async def on_ready():
-    print(f'🤖 {bot.user} ready - Python {sys.version[:5]}')
+    bot.state.target_channel = bot.get_channel(VOICE_CHANNEL_ID)
+    if not bot.state.target_channel:
+        logger.warning("⚠️  Voice channel %s not found", VOICE_CHANNEL_ID)
+    logger.info("🤖 %s ready - Python %s", bot.user, sys.version[:5])
 
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    global voice_client, disconnect_timer
-
     if member.bot:
         return
 
-    target_channel = bot.get_channel(VOICE_CHANNEL_ID)
+    # Ignore updates that neither enter nor leave the target channel
+    before_id = before.channel.id if before.channel else 0
+    after_id = after.channel.id if after.channel else 0
+    if before_id != VOICE_CHANNEL_ID and after_id != VOICE_CHANNEL_ID:
+        return
+
+    state = bot.state
+    target_channel = state.target_channel
     if not target_channel:
         return
 
     # Someone entered the target channel
-    if after.channel and after.channel.id == VOICE_CHANNEL_ID and (not before.channel or before.channel.id != VOICE_CHANNEL_ID):
-        print(f"👤 {member.name} joined")
-
-        embed = discord.Embed(
-            title="🌬️ BREATHING BRIDGE ACTIVATED",
-            description="INHALE 4s → HOLD 7s → EXHALE 8s",
-            color=0x00ff88
-        )
-        if os.getenv("GIF_URL"):
-            embed.set_image(url=os.getenv("GIF_URL"))
+    if after_id == VOICE_CHANNEL_ID and before_id != VOICE_CHANNEL_ID:
+        logger.info("👤 %s joined", member.name)
 
         try:
-            await target_channel.send(embed=embed)
+            await target_channel.send(embed=BREATHING_EMBED)
         except:
             pass
 
-        if not voice_client or not voice_client.is_connected():
-            try:
-                if voice_client:
-                    await voice_client.disconnect()
-
-                # --- replaced single .connect() with robust helper ---
-                voice_client = await connect_voice(target_channel)
-                await play_music(voice_client)
-                print(f"✅ Connected to {target_channel.name}")
-            except Exception as e:
-                print(f"❌ Connection failed: {e}")
-                return
-
-        if disconnect_timer:
-            disconnect_timer.cancel()
-        disconnect_timer = asyncio.create_task(schedule_disconnect())
+        # Joins that land while a connect is in flight wait for it instead
+        # of starting a second connect/decode of their own
+        async with state.connect_lock:
+            if not state.vc or not state.vc.is_connected():
+                try:
+                    if state.vc:
+                        await teardown_voice(state.vc)
+
+                    # --- replaced single .connect() with robust helper ---
+                    state.vc = await connect_voice(target_channel)
+                    await play_music(state.vc)
+                    logger.info("✅ Connected to %s", target_channel.name)
+                except Exception:
+                    logger.exception("❌ Connection failed")
+                    return
+
+        state.deadline = time.monotonic() + 600
+        if not state.disconnect_task or state.disconnect_task.done():
+            state.disconnect_task = asyncio.create_task(schedule_disconnect())
 
     # Someone left the target channel
-    elif before.channel and before.channel.id == VOICE_CHANNEL_ID and (not after.channel or after.channel.id != VOICE_CHANNEL_ID):
-        print(f"👋 {member.name} left")
-
-        human_members = [m for m in target_channel.members if not m.bot]
-        if not human_members and voice_client and voice_client.is_connected():
-            if disconnect_timer:
-                disconnect_timer.cancel()
-            await voice_client.disconnect()
-            voice_client = None
-            disconnect_timer = None
-            print("🏃 Disconnected – channel empty")
+    elif before_id == VOICE_CHANNEL_ID and after_id != VOICE_CHANNEL_ID:
+        logger.info("👋 %s left", member.name)
+
+        has_human = any(not m.bot for m in target_channel.members)
+        if not has_human:
+            # Hold the lock so a rejoin can't connect while the old client
+            # is still registered with discord.py
+            async with state.connect_lock:
+                if state.vc and state.vc.is_connected():
+                    if state.disconnect_task:
+                        state.disconnect_task.cancel()
+                        state.disconnect_task = None
+                    await teardown_voice(state.vc)
+                    state.vc = None
+                    logger.info("🏃 Disconnected – channel empty")
 
 
 # -------------------------------------------------------------
-# Text commands
+# Slash commands
 # -------------------------------------------------------------
-@bot.command()
-async def status(ctx):
+@tree.command()
+async def status(interaction: discord.Interaction):
     """Check bot status."""
-    if voice_client and voice_client.is_connected():
-        playing = "🎵 Yes" if voice_client.is_playing() else "🔇 No"
-        await ctx.send(f"Connected to {voice_client.channel.name} | Playing: {playing}")
+    vc = bot.state.vc
+    if vc and vc.is_connected():
+        playing = "🎵 Yes" if vc.is_playing() else "🔇 No"
+        await interaction.response.send_message(f"Connected to {vc.channel.name} | Playing: {playing}")
     else:
-        await ctx.send("Not connected to voice")
+        await interaction.response.send_message("Not connected to voice")
 
 
-@bot.command()
-async def stop(ctx):
+@tree.command()
+async def stop(interaction: discord.Interaction):
     """Stop the MP3."""
-    if voice_client and voice_client.is_playing():
-        voice_client.stop()
-        await ctx.send("🔇 Stopped")
+    vc = bot.state.vc
+    if vc and vc.is_playing():
+        vc.stop()
+        await interaction.response.send_message("🔇 Stopped")
     else:
-        await ctx.send("Nothing playing")
+        await interaction.response.send_message("Nothing playing")
 
 
 # -------------------------------------------------------------
 # Run the bot
 # -------------------------------------------------------------
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
     token = os.getenv("BOT_TOKEN")
     if not token:
-        print("❌ BOT_TOKEN not found!")
+        logger.error("❌ BOT_TOKEN not found!")
+        sys.exit(1)
+
+    if not VOICE_CHANNEL_ID:
+        logger.error("❌ VOICE_CHANNEL_ID not found!")
         sys.exit(1)
 
     if not os.path.isfile(LOCAL_MP3_PATH):
-        print("⚠️  WARNING: LOCAL_MP3_PATH does not point to a valid file!")
-        print("   Please edit LOCAL_MP3_PATH in this file before running the bot.")
+        logger.warning("⚠️  WARNING: LOCAL_MP3_PATH does not point to a valid file!")
+        logger.warning("   Please edit LOCAL_MP3_PATH in this file before running the bot.")
+
+    # uvloop has no Windows build; fall back to the stock loop there
+    if sys.platform != "win32":
+        import uvloop
+        uvloop.install()
 
-    bot.run(token)
\ No newline at end of file
+    # Logging is configured above; stop discord.py adding a second root handler
+    bot.run(token, log_handler=None)
\ No newline at end of file